@@ -14,14 +14,26 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+import dbm
+import gc
+import importlib
 import os.path
-import sys
 import threading
 import time
+from collections import deque, OrderedDict
+from multiprocessing.pool import ThreadPool
 
 from trackma import messenger
 from trackma import utils
 
+if os.name == 'nt':
+    import msvcrt
+else:
+    import fcntl
+
+# API classes already imported, by API name
+_api_classes = {}
+
 class Data():
     """
     Data Handler Class
@@ -38,26 +50,38 @@ class Data():
     name = 'Data'
     version = 5
 
-    msg = None
-    api = None
-    showlist = None
-    infocache = dict()
-    queue = list()
-    config = dict()
-    meta = {'lastget': 0, 'lastsend': 0, 'version': '', 'altnames': {}, 'library': {}, 'library_cache': {}, }
-
-    autosend_timer = None
-
-    signals = {
-                'show_synced':       None,
-                'sync_complete':     None,
-                'queue_changed':     None,
-              }
+    __slots__ = ('msg', 'api', 'mediainfo', 'showlist', 'infocache',
+                 'queue', 'queue_index', 'config', 'meta',
+                 'signals', 'userconfig', 'userconfig_file', 'queue_file',
+                 'info_file', 'cache_file', 'meta_file', 'lock_file', 'lock_fd',
+                 'autosend_timer', 'cache_timer', 'cache_lock', 'cache_dirty',
+                 'cache_save_delay')
 
     def __init__(self, messenger, config, account, mediatype):
         """Checks if the config is correct and creates an API object."""
         self.msg = messenger
         self.config = config
+        self.api = None
+        self.mediainfo = None
+        self.showlist = None
+        self.infocache = None
+        self.queue = deque()
+        self.queue_index = {}
+        self.meta = {'lastget': 0, 'lastsend': 0, 'version': '', 'altnames': {}, 'library': {}, 'library_cache': {}, }
+
+        self.autosend_timer = None
+        self.lock_fd = None
+        self.cache_timer = None
+        self.cache_lock = threading.RLock()
+        self.cache_dirty = False
+        self.cache_save_delay = 2
+
+        self.signals = {
+                    'show_synced':       None,
+                    'sync_complete':     None,
+                    'queue_changed':     None,
+                  }
+
         self.msg.info(self.name, "Initializing...")
 
         # Get filenames
@@ -73,16 +97,18 @@ class Data():
         # Import the API
         libbase = account['api']
         libname = "lib{0}".format(libbase)
-        try:
-            modulename = "trackma.lib.{0}".format(libname)
-            __import__(modulename)
-            apimodule = sys.modules[modulename]
-        except ImportError as e:
-            raise utils.DataFatal("Couldn't import API module: %s" % e)
+        libclass = _api_classes.get(libbase)
+        if not libclass:
+            try:
+                apimodule = importlib.import_module("trackma.lib.{0}".format(libname))
+            except ImportError as e:
+                raise utils.DataFatal("Couldn't import API module: %s" % e)
+
+            libclass = _api_classes[libbase] = getattr(apimodule, libname)
 
         # Instance API
-        libclass = getattr(apimodule, libname)
         self.api = libclass(self.msg, account, self.userconfig)
+        self.mediainfo = self.api.media_info()
 
         # Set mediatype
         mediatype = self.userconfig.get('mediatype')
@@ -90,7 +116,7 @@ class Data():
 
         # Get filenames
         self.queue_file = utils.get_filename(userfolder, '%s.queue' % mediatype)
-        self.info_file = utils.get_filename(userfolder,  '%s.info' % mediatype)
+        self.info_file = utils.get_filename(userfolder,  '%s.infodb' % mediatype)
         self.cache_file = utils.get_filename(userfolder, '%s.list' % mediatype)
         self.meta_file = utils.get_filename(userfolder, '%s.meta' % mediatype)
         self.lock_file = utils.get_filename(userfolder,  'lock')
@@ -140,10 +166,13 @@ class Data():
         if self._queue_exists() and self.meta.get('version') == self.version:
             self._load_queue()
             self._emit_signal('queue_changed', self.queue)
+        else:
+            # Start a new journal, so queue changes aren't appended
+            # to a stale one that would be loaded on the next start
+            self._save_queue()
 
-        if self._info_exists() and self.meta.get('version') == self.version:
-            # Load info cache only if we're on the same database version
-            self._load_info()
+        # Keep the info cache only if we're on the same database version
+        self._load_info(self.meta.get('version') == self.version)
 
         # If there is a list cache, load from it
         # otherwise query the API for a remote list
@@ -179,7 +208,7 @@ class Data():
         if self.config['autosend'] in ('minutes', 'hours'):
             self.autosend()
 
-        return (self.api.api_info, self.api.media_info())
+        return (self.api.api_info, self.mediainfo)
 
     def unload(self, force=False):
         """
@@ -195,13 +224,22 @@ class Data():
         if self.autosend_timer:
             self.autosend_timer.cancel()
 
+        # Cancel pending cache save, we'll do it now if needed
+        if self.cache_timer:
+            self.cache_timer.cancel()
+
         # We push changes if specified on config file
         if not force:
             if self.config['autosend_at_exit']:
                 self.process_queue()
 
+            if self.cache_dirty:
+                self._save_cache()
             self._save_meta()
 
+        if self.infocache:
+            self.infocache.close()
+
         self._unlock()
 
     def get(self):
@@ -236,22 +274,21 @@ class Data():
         self.showlist[showid] = show
 
         # Check if the show add is already in queue
-        exists = False
-        for q in self.queue:
-            if q['id'] == showid and q['action'] == 'add':
-                # This shouldn't happen
-                raise utils.DataError("Show already in the queue.")
-
-        if not exists:
-            # Use the whole show as a queue item
-            item = show
-            item['action'] = 'add'
-            self.queue.append(item)
+        if (showid, 'add') in self.queue_index:
+            # This shouldn't happen
+            raise utils.DataError("Show already in the queue.")
+
+        # Create queue item with the user's values of the show
+        # (not the show itself, we don't want the action in the list)
+        item = self._new_queue_item(show, 'add')
+        item.update((key, value) for key, value in show.items() if key.startswith('my_'))
+        self.queue.append(item)
+        self.queue_index[(showid, 'add')] = item
 
         show['queued'] = True
 
-        self._save_queue()
-        self._save_cache()
+        self._append_queue(item)
+        self._schedule_save_cache()
         self._emit_signal('queue_changed', self.queue)
         self.msg.info(self.name, "Queued add for %s" % show['title'])
 
@@ -273,28 +310,23 @@ class Data():
         show[key] = value
 
         # Check if the show update is already in queue
-        exists = False
-        for q in self.queue:
-            if q['id'] == show['id'] and q['action'] in ['add', 'update']:
-                # Add the changed value to the already existing queue item
-                q[key] = value
-                exists = True
-                break
-
-        if not exists:
+        item = (self.queue_index.get((show['id'], 'add')) or
+                self.queue_index.get((show['id'], 'update')))
+
+        if item:
+            # Add the changed value to the already existing queue item
+            item[key] = value
+        else:
             # Create queue item and append it
-            item = {'id': show['id'],
-                    'my_id': show['my_id'],
-                    'action': 'update',
-                    'title': show['title'],
-                   }
+            item = self._new_queue_item(show, 'update')
             item[key] = value
             self.queue.append(item)
+            self.queue_index[(show['id'], 'update')] = item
 
         show['queued'] = True
 
-        self._save_queue()
-        self._save_cache()
+        self._append_queue(item)
+        self._schedule_save_cache()
         self._emit_signal('queue_changed', self.queue)
         self.msg.info(self.name, "Queued update for %s" % show['title'])
 
@@ -318,31 +350,39 @@ class Data():
         if not self.showlist.get(showid):
             raise utils.DataError("Show not in the list.")
 
-        item = self.showlist.pop(showid)
+        # Check if the show delete is already in queue
+        if (showid, 'delete') in self.queue_index:
+            # This shouldn't happen
+            raise utils.DataError("Show delete already in the queue.")
 
-        # Check if the show add is already in queue
-        exists = False
-        for q in self.queue:
-            if q['id'] == showid and q['action'] == 'delete':
-                # This shouldn't happen
-                raise utils.DataError("Show delete already in the queue.")
-
-        if not exists:
-            # Use the whole show as a queue item
-            item['action'] = 'delete'
-            self.queue.append(item)
+        self.showlist.pop(showid)
+
+        # Create queue item with what the APIs need to delete it
+        # (not the show itself, the caller still holds it)
+        item = self._new_queue_item(show, 'delete')
+        self.queue.append(item)
+        self.queue_index[(showid, 'delete')] = item
 
         show['queued'] = True
 
-        self._save_queue()
-        self._save_cache()
+        self._append_queue(item)
+        self._schedule_save_cache()
         self._emit_signal('queue_changed', self.queue)
         self.msg.info(self.name, "Queued delete for %s" % item['title'])
 
+    def _new_queue_item(self, show, action):
+        return {
+            'id': show['id'],
+            'my_id': show['my_id'],
+            'action': action,
+            'title': show['title'],
+        }
+
     def queue_clear(self):
         """Clears the queue completely."""
         if self.queue:
-            self.queue = []
+            self.queue = deque()
+            self.queue_index = {}
             self._save_queue()
             self._emit_signal('queue_changed', self.queue)
             self.msg.info(self.name, "Cleared queue.")
@@ -363,63 +403,136 @@ class Data():
             if not self.showlist:
                 self._load_cache()
 
-            # Check log-in TODO
-            #try:
-            #    self.api.check_credentials()
-            #except utils.APIError as e:
-            #    raise utils.DataError("Can't process queue, will leave unsynced. Reason: %s" % e)
+            # Log in once before sending anything, instead of from every pool thread
+            try:
+                self.api.check_credentials()
+            except NotImplementedError:
+                pass
+            except utils.APIError as e:
+                self.msg.warn(self.name, "Can't log in, will leave queue unsynced.")
+                self.msg.debug(self.name, "Info: %s" % e)
+                return
 
-            # Run through queue
             items_processed = []
-            for i in range(len(self.queue)):
-                item = self.queue.pop(0)
-                showid = item['id']
 
-                try:
-                    show = self.showlist[showid]
-                except KeyError:
-                    show = None
+            # Send all the pending updates at once if the API supports it
+            updates = [item for item in self.queue
+                       if item['action'] == 'update' and (item['id'], 'add') not in self.queue_index]
 
+            # Take the items being sent out of the index, so changes made
+            # meanwhile go to new queue items instead of getting merged
+            # into these ones and lost once they're sent
+            self.queue_index = {}
+
+            if len(updates) > 1:
                 try:
-                    # Call the API to do the requested operation
-                    operation = item.get('action')
-                    if operation == 'add':
-                        my_id = self.api.add_show(item)
-
-                        if my_id:
-                            show['my_id'] = my_id
-                    elif operation == 'update':
-                        self.api.update_show(item)
-                    elif operation == 'delete':
-                        self.api.delete_show(item)
-                    else:
-                        self.msg.warn(self.name, "Unknown operation in queue (%s), skipping..." % repr(operation))
-
-                    if self.showlist.get(showid):
-                        self.showlist[showid]['queued'] = False
-                        self._emit_signal('show_synced', show, item)
-
-                    items_processed.append((show, item))
-                    self._emit_signal('queue_changed', self.queue)
+                    self.api.batch_update_shows(updates)
+                except NotImplementedError:
+                    pass
                 except utils.APIError as e:
-                    self.msg.warn(self.name, "Can't process %s, will leave unsynced." % item['title'])
+                    self.msg.warn(self.name, "Can't send updates at once, will send them one by one.")
                     self.msg.debug(self.name, "Info: %s" % e)
-                    self.queue.append(item)
-                except NotImplementedError:
-                    self.msg.warn(self.name, "Operation not implemented in API. Skipping...")
-                    self.queue.append(item)
-                #except TypeError:
-                #    self.msg.warn(self.name, "%s not in list, unexpected. Not changing queued status." % showid)
+                else:
+                    sent = set(id(item) for item in updates)
+                    self.queue = deque(item for item in list(self.queue) if id(item) not in sent)
+
+                    for item in updates:
+                        show = self.showlist.get(item['id'])
+                        if show:
+                            if (item['id'], 'update') not in self.queue_index:
+                                show['queued'] = False
+                            self._emit_signal('show_synced', show, item)
+
+                        items_processed.append((show, item))
+
+                    self._emit_signal('queue_changed', self.queue)
+
+            # Run through queue, sending the operations of different shows
+            # in parallel if the API allows it, and the ones of the same show in order
+            groups = OrderedDict()
+            for item in self.queue:
+                groups.setdefault(item['id'], []).append(item)
+
+            threads = min(self.config['sync_threads'],
+                          self.api.api_info.get('max_sync_threads', 1),
+                          len(groups))
+
+            # Same as above, for anything queued while the batch was sent
+            self.queue_index = {}
+
+            if threads > 1:
+                pool = ThreadPool(threads)
+                results = pool.imap_unordered(self._send_items, groups.values())
+            else:
+                pool = None
+                results = map(self._send_items, groups.values())
+
+            try:
+                for group_results in results:
+                    for item, my_id, error in group_results:
+                        showid = item['id']
+                        show = self.showlist.get(showid)
+
+                        if isinstance(error, utils.APIError):
+                            self.msg.warn(self.name, "Can't process %s, will leave unsynced." % item['title'])
+                            self.msg.debug(self.name, "Info: %s" % error)
+                            continue
+                        elif isinstance(error, NotImplementedError):
+                            self.msg.warn(self.name, "Operation not implemented in API. Skipping...")
+                            continue
+
+                        if show:
+                            if my_id:
+                                show['my_id'] = my_id
+
+                            if (showid, 'update') not in self.queue_index:
+                                show['queued'] = False
+                            self._emit_signal('show_synced', show, item)
+
+                        items_processed.append((show, item))
+
+                        # Failed items stay at the front, so this one is found quickly
+                        self.queue.remove(item)
+                        self._emit_signal('queue_changed', self.queue)
+            finally:
+                # Keep the sent items out of the queue file even if something
+                # unexpected happened, so they aren't sent again
+                if pool:
+                    pool.terminate()
+                self._index_queue()
+                self._save_queue()
 
             self.api.logout()
             self._save_cache()
-            self._save_queue()
             self._emit_signal('sync_complete', items_processed)
         else:
             self.msg.debug(self.name, 'No items in queue.')
 
         self.meta['lastsend'] = time.time()
 
+    def _send_items(self, items):
+        # Sends the queued operations of a single show, runs in the sync pool
+        results = []
+        for item in items:
+            try:
+                results.append((item, self._send_item(item), None))
+            except (utils.APIError, NotImplementedError) as e:
+                results.append((item, None, e))
+
+        return results
+
+    def _send_item(self, item):
+        # Call the API to do the requested operation
+        operation = item.get('action')
+        if operation == 'add':
+            return self.api.add_show(item)
+        elif operation == 'update':
+            self.api.update_show(item)
+        elif operation == 'delete':
+            self.api.delete_show(item)
+        else:
+            self.msg.warn(self.name, "Unknown operation in queue (%s), skipping..." % repr(operation))
+
     def info_get(self, show):
         try:
             showid = show['id']
@@ -488,19 +601,77 @@ class Data():
 
     def _load_cache(self):
         self.msg.debug(self.name, "Reading cache...")
-        self.showlist = utils.load_data(self.cache_file)
+        # The collector would walk the list over and over while
+        # it's being built, so hold it off until we're done
+        gc.disable()
+        try:
+            self.showlist = utils.columns_to_dicts(utils.load_packed(self.cache_file))
+        finally:
+            gc.enable()
+        self._replay_queue()
 
     def _save_cache(self):
         self.msg.debug(self.name, "Saving cache...")
-        utils.save_data(self.showlist, self.cache_file)
+        with self.cache_lock:
+            self.cache_dirty = False
+            utils.save_packed(utils.dicts_to_columns(dict(self.showlist)), self.cache_file, compress=True)
+
+    def _schedule_save_cache(self):
+        # Group the cache saves of quick successive changes
+        # into a single one done a bit later in the background
+        with self.cache_lock:
+            self.cache_dirty = True
+            if not self.cache_timer:
+                self.cache_timer = threading.Timer(self.cache_save_delay, self._flush_cache)
+                self.cache_timer.daemon = True
+                self.cache_timer.start()
+
+    def _flush_cache(self):
+        with self.cache_lock:
+            self.cache_timer = None
+            if self.cache_dirty:
+                self._save_cache()
+
+    def _replay_queue(self):
+        # The cache isn't saved on every queue change, so it might be
+        # older than the queue. Apply the queued changes on top of it.
+        for item in self.queue:
+            showid = item['id']
+            operation = item.get('action')
+            if operation == 'add' and showid not in self.showlist:
+                show = utils.show()
+                show.update((key, value) for key, value in item.items() if key != 'action')
+                self.showlist[showid] = show
+            elif operation in ('add', 'update') and showid in self.showlist:
+                # Updates made after an add are merged into the add item
+                show = self.showlist[showid]
+                for key, value in item.items():
+                    if key in show and key not in ('id', 'my_id', 'action'):
+                        show[key] = value
+            else:
+                if operation == 'delete':
+                    self.showlist.pop(showid, None)
+                continue
+
+            show['queued'] = True
+
+    def _load_info(self, keep=True):
+        self.msg.debug(self.name, "Opening info DB...")
+        try:
+            self.infocache = utils.LRUShelf(self.info_file, 'c' if keep else 'n')
+        except dbm.error as e:
+            # The DB might be locked by another running instance
+            self.msg.warn(self.name, "Couldn't open info DB, it won't be saved this session: %s" % e)
+            self.infocache = utils.LRUShelf(None)
 
-    def _load_info(self):
-        self.msg.debug(self.name, "Reading info DB...")
-        self.infocache = utils.load_data(self.info_file)
+        # Remove the info cache left over from the old pickle format
+        old_info_file = os.path.splitext(self.info_file)[0] + '.info'
+        if os.path.isfile(old_info_file):
+            os.unlink(old_info_file)
 
     def _save_info(self):
         self.msg.debug(self.name, "Saving info DB...")
-        utils.save_data(self.infocache, self.info_file)
+        self.infocache.sync()
 
     def _load_userconfig(self):
         self.msg.debug(self.name, "Reading userconfig...")
@@ -512,11 +683,40 @@ class Data():
 
     def _load_queue(self):
         self.msg.debug(self.name, "Reading queue...")
-        self.queue = utils.load_data(self.queue_file)
+        self.queue = deque()
+        self.queue_index = {}
+
+        # Every record in the journal is the latest state of a queue
+        # item, so replace the older one if we've already seen it.
+        gc.disable()
+        try:
+            records = utils.load_journal(self.queue_file)
+        finally:
+            gc.enable()
+
+        for record in records:
+            key = (record['id'], record['action'])
+            item = self.queue_index.get(key)
+            if item:
+                item.clear()
+                item.update(record)
+            else:
+                self.queue.append(record)
+                self.queue_index[key] = record
+
+        # Compact the journal so it doesn't keep growing between syncs
+        self._save_queue()
+
+    def _index_queue(self):
+        self.queue_index = dict(((item['id'], item['action']), item) for item in self.queue)
+
+    def _append_queue(self, item):
+        self.msg.debug(self.name, "Appending to queue...")
+        utils.append_journal(item, self.queue_file)
 
     def _save_queue(self):
         self.msg.debug(self.name, "Saving queue...")
-        utils.save_data(self.queue, self.queue_file)
+        utils.save_journal(self.queue, self.queue_file)
 
     def _load_meta(self):
         self.msg.debug(self.name, "Reading metadata...")
@@ -574,9 +774,6 @@ class Data():
     def _cache_exists(self):
         return os.path.isfile(self.cache_file)
 
-    def _info_exists(self):
-        return os.path.isfile(self.info_file)
-
     def _queue_exists(self):
         return os.path.isfile(self.queue_file)
 
@@ -584,25 +781,39 @@ class Data():
         return os.path.isfile(self.meta_file)
 
     def _lock(self):
-        """Creates the database lock, returns an exception if it
-        already exists"""
+        """Takes the database lock, returns an exception if another
+        process is holding it"""
         if self.config['debug_disable_lock']:
             return
 
-        if os.path.isfile(self.lock_file):
-            raise utils.DataFatal("Database is locked by another process. "
-                            "If you\'re sure there's no other process is using it, "
-                            "remove the file ~/.trackma/lock")
-
-        f = open(self.lock_file, 'w')
-        f.close()
+        # The OS releases the lock by itself if we die,
+        # so there's no stale lock to worry about
+        self.lock_fd = open(self.lock_file, 'w')
+        try:
+            if os.name == 'nt':
+                msvcrt.locking(self.lock_fd.fileno(), msvcrt.LK_NBLCK, 1)
+            else:
+                fcntl.flock(self.lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            self.lock_fd.close()
+            self.lock_fd = None
+            raise utils.DataFatal("Database is locked by another process.")
 
     def _unlock(self):
-        """Removes the database lock"""
-        if self.config['debug_disable_lock']:
+        """Releases the database lock"""
+        if not self.lock_fd:
             return
 
-        os.unlink(self.lock_file)
+        # The lock file itself is left in place; removing it would let
+        # another process lock a new file while one is waiting on this one
+        if os.name == 'nt':
+            self.lock_fd.seek(0)
+            msvcrt.locking(self.lock_fd.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            fcntl.flock(self.lock_fd, fcntl.LOCK_UN)
+
+        self.lock_fd.close()
+        self.lock_fd = None
 
     def get_api_info(self):
-        return (self.api.api_info, self.api.media_info())
+        return (self.api.api_info, self.mediainfo)
@@ -32,6 +32,9 @@ class lib():
     api_info is a dictionary containing useful information about the API itself
     name: API name
     version: API version
+    max_sync_threads: (Optional) Number of queue items that can be sent at the same
+    time from different threads. Only set it if the API is thread-safe, and keep
+    it within the site's rate limit. Defaults to 1.
     """
 
     mediatypes = dict()
@@ -130,6 +133,16 @@ class lib():
         """
         raise NotImplementedError
 
+    def batch_update_shows(self, items):
+        """
+        Sends the updates of several shows to the remote site in a single request.
+
+        Implementing this is optional; if it's not implemented the Data Handler
+        will call :func:`update_show` for each item instead. It should either send
+        all the **items** or raise an APIError.
+        """
+        raise NotImplementedError
+
     def delete_show(self, item):
         """
         Deletes the **item** in the remote server list. The **item** is a show dictionary passed by the Data Handler.
@@ -15,15 +15,31 @@
 #
 
 import os, re, shutil, copy
+import sys
+import struct
+import contextlib
 import subprocess
 import datetime
 import json
 import difflib
 import pickle
+import shelve
+import collections
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 VERSION = '0.7.2'
 
 datadir = os.path.dirname(__file__)
+IO_BUFFER_SIZE = 1 << 20
 LOGIN_PASSWD = 1
 LOGIN_OAUTH = 2
 
@@ -83,13 +99,214 @@ def save_config(config_dict, filename):
         configfile.write(json.dumps(config_dict, sort_keys=True,
                   indent=4, separators=(',', ': ')).encode('utf-8'))
 
+@contextlib.contextmanager
+def atomic_open(filename):
+    """
+    Opens a temporary file for writing that replaces filename
+    only once it has been completely written and synced to disk,
+    so a crash never leaves a half-written file behind.
+    """
+    tmpname = filename + '.tmp'
+    try:
+        with open(tmpname, 'wb', buffering=IO_BUFFER_SIZE) as datafile:
+            yield datafile
+            datafile.flush()
+            os.fsync(datafile.fileno())
+    except:
+        if os.path.isfile(tmpname):
+            os.unlink(tmpname)
+        raise
+
+    os.replace(tmpname, filename)
+
 def load_data(filename):
-    with open(filename, 'rb') as datafile:
+    with open(filename, 'rb', buffering=IO_BUFFER_SIZE) as datafile:
         return pickle.load(datafile, encoding='bytes')
 
 def save_data(data, filename):
-    with open(filename, 'wb') as datafile:
-        pickle.dump(data, datafile, protocol=2)
+    with atomic_open(filename) as datafile:
+        pickle.dump(data, datafile, protocol=pickle.HIGHEST_PROTOCOL)
+
+# msgpack extension types for the values pickle handled for us
+MSGPACK_EXT_DATETIME = 1
+MSGPACK_EXT_DATE = 2
+
+def _msgpack_default(obj):
+    if isinstance(obj, datetime.datetime):
+        return msgpack.ExtType(MSGPACK_EXT_DATETIME, obj.strftime('%Y%m%d%H%M%S%f').encode('ascii'))
+    elif isinstance(obj, datetime.date):
+        return msgpack.ExtType(MSGPACK_EXT_DATE, obj.strftime('%Y%m%d').encode('ascii'))
+    raise TypeError("Can't serialize %r" % obj)
+
+def _msgpack_ext_hook(code, data):
+    if code == MSGPACK_EXT_DATETIME:
+        return datetime.datetime.strptime(data.decode('ascii'), '%Y%m%d%H%M%S%f')
+    elif code == MSGPACK_EXT_DATE:
+        return datetime.datetime.strptime(data.decode('ascii'), '%Y%m%d').date()
+    return msgpack.ExtType(code, data)
+
+def pack_data(data):
+    """Serializes data with msgpack if available, pickle otherwise."""
+    if msgpack:
+        return msgpack.packb(data, use_bin_type=True, default=_msgpack_default)
+    else:
+        return pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL)
+
+def unpack_data(buf):
+    """Deserializes data produced by pack_data (or an old pickle)."""
+    # Pickle streams (protocol 2+) start with the PROTO opcode,
+    # which can't be the start of a msgpack object longer than a byte.
+    if buf[:1] == b'\x80' and len(buf) > 1:
+        return pickle.loads(buf, encoding='bytes')
+
+    if not msgpack:
+        raise DataError("msgpack is needed to read this file.")
+    return msgpack.unpackb(buf, raw=False, strict_map_key=False, ext_hook=_msgpack_ext_hook)
+
+def dicts_to_columns(dicts):
+    """
+    Converts a dictionary of dictionaries (like a show list) to a list of
+    column tables for storage. Dictionaries with the same keys share a table
+    [keys, ids, columns], so each key is only stored once per table.
+    """
+    tables = {}
+    for dictid, d in dicts.items():
+        items = list(d.items())
+        keys = tuple(key for key, value in items)
+        try:
+            table = tables[keys]
+        except KeyError:
+            table = tables[keys] = [list(keys), [], [[] for key in keys]]
+
+        table[1].append(dictid)
+        for column, (key, value) in zip(table[2], items):
+            column.append(value)
+
+    return list(tables.values())
+
+def columns_to_dicts(tables):
+    """Converts the output of dicts_to_columns back to a dictionary of dictionaries."""
+    if isinstance(tables, dict):
+        # Stored before column tables were used
+        return tables
+
+    dicts = {}
+    for keys, ids, columns in tables:
+        # Share a single copy of the keys and of repeated string values
+        # (statuses, types...) among all the dictionaries
+        keys = [sys.intern(key) if isinstance(key, str) else key for key in keys]
+        columns = [[sys.intern(value) if isinstance(value, str) else value for value in column]
+                   for column in columns]
+
+        rows = zip(*columns) if columns else [()] * len(ids)
+        for dictid, values in zip(ids, rows):
+            dicts[dictid] = dict(zip(keys, values))
+
+    return dicts
+
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+def load_packed(filename):
+    with open(filename, 'rb', buffering=IO_BUFFER_SIZE) as datafile:
+        buf = datafile.read()
+
+    if buf[:4] == ZSTD_MAGIC:
+        if not zstandard:
+            raise DataError("zstandard is needed to read %s." % filename)
+        buf = zstandard.ZstdDecompressor().decompress(buf)
+
+    return unpack_data(buf)
+
+def save_packed(data, filename, compress=False):
+    """Saves data with pack_data, compressed with zstd if asked and available."""
+    buf = pack_data(data)
+    if compress and zstandard:
+        buf = zstandard.ZstdCompressor(level=3).compress(buf)
+
+    with atomic_open(filename) as datafile:
+        datafile.write(buf)
+
+def load_journal(filename):
+    """Reads all the records of a journal file written by append_journal."""
+    with open(filename, 'rb', buffering=IO_BUFFER_SIZE) as datafile:
+        buf = datafile.read()
+
+    # Files written before the journal format hold one single list.
+    # A frame header always starts with a null byte.
+    if buf and buf[:1] != b'\x00':
+        return unpack_data(buf)
+
+    records = []
+    pos = 0
+    while pos + 4 <= len(buf):
+        (length,) = struct.unpack_from('>I', buf, pos)
+        pos += 4
+        if pos + length > len(buf):
+            # Torn write at the end of the file; drop it
+            break
+        records.append(unpack_data(buf[pos:pos+length]))
+        pos += length
+
+    return records
+
+def _journal_frame(record):
+    buf = pack_data(record)
+    return struct.pack('>I', len(buf)) + buf
+
+def append_journal(record, filename):
+    with open(filename, 'ab') as datafile:
+        datafile.write(_journal_frame(record))
+
+def save_journal(records, filename):
+    with atomic_open(filename) as datafile:
+        datafile.write(b''.join(_journal_frame(record) for record in records))
+
+class LRUShelf():
+    """
+    Dictionary-like store kept on disk with shelve
+
+    Only the most recently used items are kept in memory,
+    the rest are read from disk when they're requested.
+
+    filename: Shelf file to use, or None to keep everything in memory
+    flag: Same as in shelve.open ('c' to open or create, 'n' to start empty)
+    capacity: Number of items to keep in memory
+
+    """
+    def __init__(self, filename, flag='c', capacity=256):
+        if filename is None:
+            self.shelf = shelve.Shelf({}, protocol=pickle.HIGHEST_PROTOCOL)
+        else:
+            self.shelf = shelve.open(filename, flag, protocol=pickle.HIGHEST_PROTOCOL)
+        self.capacity = capacity
+        self.items = collections.OrderedDict()
+
+    def __getitem__(self, key):
+        key = str(key)
+        try:
+            value = self.items[key]
+            self.items.move_to_end(key)
+        except KeyError:
+            value = self.shelf[key]
+            self._remember(key, value)
+        return value
+
+    def __setitem__(self, key, value):
+        key = str(key)
+        self.shelf[key] = value
+        self.items.pop(key, None)
+        self._remember(key, value)
+
+    def _remember(self, key, value):
+        self.items[key] = value
+        if len(self.items) > self.capacity:
+            self.items.popitem(last=False)
+
+    def sync(self):
+        self.shelf.sync()
+
+    def close(self):
+        self.shelf.close()
 
 def log_error(msg):
     with open(get_root_filename('error.log'), 'a') as logfile:
@@ -279,6 +496,7 @@ config_defaults = {
     'autosend_minutes': 60,
     'autosend_size': 5,
     'autosend_at_exit': True,
+    'sync_threads': 1,
     'library_autoscan': True,
     'debug_disable_lock': True,
     'auto_status_change': True,